@@ -4,27 +4,38 @@ Long polling, single process, background scheduler. Data in data.json.
 """
 
 import asyncio
+import heapq
 import json
 import logging
 import os
 import re
-import threading
+import time
 
 from dotenv import load_dotenv
 
 load_dotenv()
-from datetime import datetime, timedelta
+from dataclasses import asdict, dataclass, fields
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
+from typing import Any, Coroutine
 
 from aiogram import Bot, Dispatcher, F, Router
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
 
+try:
+    import orjson  # optional: faster data.json parse/dump, falls back to stdlib json
+except ImportError:
+    orjson = None
+
 # --- Config ------------------------------------------------------------------
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 # На Render задай DATA_PATH=/data/data.json и подключи Persistent Disk к /data
 DATA_PATH = Path(os.getenv("DATA_PATH", "data.json"))
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Long-poll getUpdates timeout (seconds): Telegram holds the request open until an update arrives
+POLLING_TIMEOUT = 30
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL, logging.INFO),
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
@@ -38,38 +49,15 @@ logger = logging.getLogger("tabex")
 # Days 13–16: 1 tablet every 3 h → 4/day
 # Days 17–20: 1 tablet every 5 h → 3/day
 # Days 21–25: 1–2 tablets/day → 2 doses, 12 h apart
-def get_required_doses(day: int) -> int:
-    if day < 1 or day > 25:
-        return 0
-    if day <= 3:
-        return 6
-    if day <= 12:
-        return 5
-    if day <= 16:
-        return 4
-    if day <= 20:
-        return 3
-    return 2
-
-
-def get_interval_hours(day: int) -> float:
-    """Hours between doses for this day. Next reminder = last_dose_time + this."""
-    if day < 1 or day > 25:
-        return 2.0
-    if day <= 3:
-        return 2.0
-    if day <= 12:
-        return 2.5
-    if day <= 16:
-        return 3.0
-    if day <= 20:
-        return 5.0
-    return 12.0  # 21–25: 2 doses per day
+# Index = course day; index 0 holds the out-of-range fallback.
+_DOSES = (0, 6, 6, 6, 5, 5, 5, 5, 5, 5, 5, 5, 5, 4, 4, 4, 4, 3, 3, 3, 3, 2, 2, 2, 2, 2)
+_INTERVALS = (
+    2.0, 2.0, 2.0, 2.0, 2.5, 2.5, 2.5, 2.5, 2.5, 2.5, 2.5, 2.5, 2.5,
+    3.0, 3.0, 3.0, 3.0, 5.0, 5.0, 5.0, 5.0, 12.0, 12.0, 12.0, 12.0, 12.0,
+)
 
 
-def get_interval_description(day: int) -> str:
-    """Human-readable interval for UI (час/часа/часов)."""
-    h = get_interval_hours(day)
+def _describe_interval(h: float) -> str:
     if h == int(h):
         n = int(h)
         if n == 1:
@@ -83,79 +71,220 @@ def get_interval_description(day: int) -> str:
     return "каждые 2,5 часа"
 
 
+_DESCS = tuple(_describe_interval(h) for h in _INTERVALS)
+
+
+def get_required_doses(day: int) -> int:
+    return _DOSES[day] if 0 <= day <= 25 else 0
+
+
+def get_interval_hours(day: int) -> float:
+    """Hours between doses for this day. Next reminder = last_dose_time + this."""
+    return _INTERVALS[day] if 0 <= day <= 25 else 2.0
+
+
+def get_interval_description(day: int) -> str:
+    """Human-readable interval for UI (час/часа/часов)."""
+    return _DESCS[day] if 0 <= day <= 25 else _DESCS[0]
+
+
+# --- User state --------------------------------------------------------------
+@dataclass(slots=True)
+class User:
+    """One user's course state; serialized field-for-field into data.json."""
+    startDate: str
+    timezone: int
+    currentDay: int = 1
+    takenToday: int = 0
+    lastDoseTimestamp: str | None = None
+    courseCompleted: bool = False
+    lastMorningMessageDate: str | None = None
+    nextReminderEpoch: float | None = None
+    postponedReminderEpoch: float | None = None
+    last21Check: str | None = None
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "User":
+        """Build from a (migrated) data.json entry, ignoring unknown keys."""
+        return cls(**{k: v for k, v in d.items() if k in _USER_FIELDS})
+
+
+_USER_FIELDS = frozenset(f.name for f in fields(User))
+
+
 # --- Data (lock + atomic write to avoid scheduler/handler race) ---------------
-_data_lock = threading.Lock()
+# Serializes saves; the file write itself runs in a worker thread so it does not block the event loop.
+_data_lock = asyncio.Lock()
 
 
 def load_data() -> dict:
-    with _data_lock:
-        if not DATA_PATH.exists():
-            return {"users": {}}
-        try:
-            with open(DATA_PATH, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception as e:
-            logger.exception("Failed to load data.json: %s", e)
-            return {"users": {}}
+    """Read data.json. Called once at import, before the event loop starts."""
+    if not DATA_PATH.exists():
+        return {"users": {}}
+    try:
+        raw = DATA_PATH.read_bytes()
+        return orjson.loads(raw) if orjson is not None else json.loads(raw)
+    except Exception as e:
+        logger.exception("Failed to load data.json: %s", e)
+        return {"users": {}}
 
 
-def save_data(data: dict) -> None:
+def _write_data(payload: bytes) -> None:
+    """Write payload to a temp file, fsync it, then rename over DATA_PATH."""
     tmp_path = DATA_PATH.with_suffix(".json.tmp")
-    with _data_lock:
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
         try:
-            with open(tmp_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            os.replace(tmp_path, DATA_PATH)
+            view = memoryview(payload)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, DATA_PATH)
+    finally:
+        if tmp_path.exists():
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
+
+
+async def save_data(data: dict) -> bool:
+    """Write data to data.json atomically. Returns False (and logs) on failure."""
+    # Serialize on the event loop so the worker thread writes a consistent snapshot
+    if orjson is not None:
+        # orjson serializes dataclasses (User) natively
+        payload = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        payload = json.dumps(data, ensure_ascii=False, indent=2, default=asdict).encode("utf-8")
+    async with _data_lock:
+        try:
+            await asyncio.to_thread(_write_data, payload)
+            return True
         except Exception as e:
             logger.exception("Failed to save data.json: %s", e)
-        finally:
-            if tmp_path.exists():
-                try:
-                    tmp_path.unlink()
-                except OSError:
-                    pass
+            return False
 
 
-# In-memory state for users during onboarding (start date / timezone)
-pending_onboarding: dict[str, dict] = {}
+# Single authoritative copy of data.json, loaded once at startup. Handlers and the
+# scheduler share one event loop, so they mutate it directly and only mark it dirty;
+# flush_data() writes it back once per handler / tick instead of on every change.
+_STATE = load_data()
+_dirty = False
 
 
-def _migrate_user_reminders(u: dict) -> bool:
-    """Replace legacy pendingReminders with nextReminderTimestamp. Returns True if migration was done."""
-    u.setdefault("nextReminderTimestamp", None)
-    u.setdefault("postponedReminderTimestamp", None)
-    if "pendingReminders" not in u or not u["pendingReminders"]:
-        if "pendingReminders" in u:
-            del u["pendingReminders"]
-            return True
+def mark_dirty() -> None:
+    global _dirty
+    _dirty = True
+
+
+async def flush_data() -> None:
+    """Save _STATE to data.json if it changed since the last flush."""
+    global _dirty
+    if _dirty:
+        # Clear first: changes made while the write is in flight mark it dirty again
+        _dirty = False
+        if not await save_data(_STATE):
+            _dirty = True
+
+
+def _migrate_user_timezone(u: dict) -> bool:
+    """Convert legacy string timezone ("+5") to int. Returns True if migration was done."""
+    tz = u.get("timezone")
+    if isinstance(tz, int):
         return False
-    # Не перезаписывать уже установленный nextReminderTimestamp (сохраняем при перезапуске)
-    if u.get("nextReminderTimestamp"):
-        del u["pendingReminders"]
-        return True
-    pending = u["pendingReminders"]
-    earliest = None
-    for pr in pending:
-        t = pr.get("triggerAt")
-        if not t:
-            continue
-        try:
-            dt = datetime.fromisoformat(t.replace("Z", "+00:00"))
-            if earliest is None or dt < earliest:
-                earliest = dt
-        except Exception:
-            continue
-    if earliest is not None:
-        u["nextReminderTimestamp"] = earliest.isoformat().replace("+00:00", "Z")
-    u["postponedReminderTimestamp"] = None
-    del u["pendingReminders"]
+    try:
+        u["timezone"] = int(tz)
+    except (ValueError, TypeError):
+        logger.warning("Invalid timezone %r in data.json, using UTC", tz)
+        u["timezone"] = 0
+    return True
+
+
+# In-memory state for users during onboarding (start date / timezone), keyed by Telegram user id.
+# Each entry carries "ts" (time.monotonic() of the last step); abandoned ones expire after the TTL.
+pending_onboarding: dict[int, dict] = {}
+PENDING_ONBOARDING_TTL = 30 * 60  # seconds
+
+
+def _pending_step(uid: int) -> str | None:
+    """Current onboarding step for uid, or None if not onboarding (or the session expired)."""
+    p = pending_onboarding.get(uid)
+    if p is None:
+        return None
+    if time.monotonic() - p["ts"] > PENDING_ONBOARDING_TTL:
+        del pending_onboarding[uid]
+        return None
+    return p["step"]
+
+
+def _gc_pending() -> None:
+    """Drop expired onboarding sessions."""
+    now = time.monotonic()
+    for k in [k for k, v in pending_onboarding.items() if now - v["ts"] > PENDING_ONBOARDING_TTL]:
+        del pending_onboarding[k]
+
+
+def _iso_to_epoch(ts: str) -> float | None:
+    """Parse an ISO UTC timestamp ('...Z' or naive) to epoch seconds. None if invalid."""
+    try:
+        dt = datetime.fromisoformat(ts.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def _migrate_user_reminders(u: dict) -> bool:
+    """
+    Replace legacy pendingReminders and ISO reminder timestamps with
+    nextReminderEpoch / postponedReminderEpoch. Returns True if migration was done.
+    """
+    u.setdefault("nextReminderEpoch", None)
+    u.setdefault("postponedReminderEpoch", None)
+    changed = False
+    for iso_key, epoch_key in (
+        ("nextReminderTimestamp", "nextReminderEpoch"),
+        ("postponedReminderTimestamp", "postponedReminderEpoch"),
+    ):
+        if iso_key in u:
+            ts = u.pop(iso_key)
+            if ts and u[epoch_key] is None:
+                u[epoch_key] = _iso_to_epoch(ts)
+            changed = True
+    if "pendingReminders" not in u:
+        return changed
+    pending = u.pop("pendingReminders") or []
+    # Не перезаписывать уже установленный nextReminderEpoch (сохраняем при перезапуске)
+    if pending and u["nextReminderEpoch"] is None:
+        epochs = [_iso_to_epoch(pr.get("triggerAt") or "") for pr in pending]
+        epochs = [e for e in epochs if e is not None]
+        if epochs:
+            u["nextReminderEpoch"] = min(epochs)
+        u["postponedReminderEpoch"] = None
     return True
 
 
+# One-time startup migration of legacy fields on the raw data.json dicts, then switch
+# to User objects; the scheduler's first pass saves the result.
+for _u in _STATE["users"].values():
+    if _migrate_user_timezone(_u):
+        mark_dirty()
+    if _migrate_user_reminders(_u):
+        mark_dirty()
+_STATE["users"] = {uid: User.from_dict(d) for uid, d in _STATE["users"].items()}
+
+
+_TZ_RE = re.compile(r"^([+-]?\d{1,2})(?::(\d{2}))?$")
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
 def parse_timezone(s: str) -> int | None:
     """Parse timezone string like '+5', '-7', '+03' to offset hours. None if invalid."""
     s = s.strip()
-    m = re.match(r"^([+-]?\d{1,2})(?::(\d{2}))?$", s)
+    m = _TZ_RE.match(s)
     if not m:
         return None
     h = int(m.group(1))
@@ -169,7 +298,7 @@ def parse_timezone(s: str) -> int | None:
 def parse_date(s: str) -> str | None:
     """Return YYYY-MM-DD if valid, else None."""
     s = s.strip()
-    if not re.match(r"^\d{4}-\d{2}-\d{2}$", s):
+    if not _DATE_RE.match(s):
         return None
     try:
         datetime.strptime(s, "%Y-%m-%d")
@@ -183,29 +312,19 @@ def user_local_now(offset_hours: int) -> datetime:
     return datetime.utcnow() + timedelta(hours=offset_hours)
 
 
-def user_local_time_str(offset_hours: int) -> str:
-    """Current time as HH:MM in user's timezone."""
-    t = user_local_now(offset_hours)
-    return t.strftime("%H:%M")
-
-
 def user_local_date_str(offset_hours: int) -> str:
     """Current date as YYYY-MM-DD in user's timezone."""
     t = user_local_now(offset_hours)
     return t.strftime("%Y-%m-%d")
 
 
-def get_user_current_day(user: dict) -> int:
+def get_user_current_day(user: User) -> int:
     """Compute current day of course from startDate and today (user timezone)."""
-    start = user["startDate"]
-    tz = int(user["timezone"])
-    today = user_local_date_str(tz)
-    if today < start:
+    today_d = user_local_now(user.timezone).date()
+    start_d = date.fromisoformat(user.startDate)
+    if today_d < start_d:
         return 0
-    start_d = datetime.strptime(start, "%Y-%m-%d")
-    today_d = datetime.strptime(today, "%Y-%m-%d")
-    delta = (today_d - start_d).days
-    return delta + 1
+    return (today_d - start_d).days + 1
 
 
 # --- Bot ---------------------------------------------------------------------
@@ -219,6 +338,11 @@ DISCLAIMER = "⚠️ Бот не является врачом и не даёт
 
 TABEX_INSTRUCTION_URL = "https://tabex.kz/"
 
+COMPLETION_MESSAGE = (
+    "Поздравляем! Вы завершили курс приёма Табекс по схеме 25 дней. "
+    "Бот является напоминалкой и не заменяет консультацию врача."
+)
+
 
 def format_date_dd_mm_yyyy(iso_date: str) -> str:
     """Format YYYY-MM-DD as DD-MM-YYYY for display."""
@@ -228,18 +352,18 @@ def format_date_dd_mm_yyyy(iso_date: str) -> str:
 
 @router.message(Command("start"))
 async def cmd_start(msg: Message) -> None:
-    uid = str(msg.from_user.id)
-    data = load_data()
-    users = data["users"]
+    uid = msg.from_user.id
+    users = _STATE["users"]
+    key = str(uid)
 
-    if uid in users:
-        u = users[uid]
-        if u.get("courseCompleted"):
+    if key in users:
+        u = users[key]
+        if u.courseCompleted:
             await msg.answer(
                 "Вы уже прошли курс. Бот является напоминалкой и не заменяет консультацию врача."
             )
             return
-        day = u.get("currentDay", 1)
+        day = u.currentDay
         if day > 25:
             await msg.answer("Курс завершён. Спасибо, что пользовались ботом.")
             return
@@ -252,27 +376,18 @@ async def cmd_start(msg: Message) -> None:
         return
 
     # Start onboarding: first ask timezone, then confirm today's date
-    pending_onboarding[uid] = {"step": "timezone"}
+    pending_onboarding[uid] = {"step": "timezone", "ts": time.monotonic()}
     await msg.answer(
         "Добро пожаловать в Tabex Reminder.\n\n"
         "Введите ваш часовой пояс (например +5 для UTC+5 или -7 для UTC-7):"
     )
 
 
-def _save_new_user(uid: str, start_date: str, tz: int) -> None:
-    data = load_data()
-    data["users"][uid] = {
-        "startDate": start_date,
-        "timezone": str(tz),
-        "currentDay": 1,
-        "takenToday": 0,
-        "lastDoseTimestamp": None,
-        "courseCompleted": False,
-        "lastMorningMessageDate": None,
-        "nextReminderTimestamp": None,
-        "postponedReminderTimestamp": None,
-    }
-    save_data(data)
+async def _save_new_user(uid: str, start_date: str, tz: int) -> None:
+    _STATE["users"][uid] = User(startDate=start_date, timezone=tz)
+    _by_tz.setdefault(tz, set()).add(uid)
+    mark_dirty()
+    await flush_data()
 
 
 def build_first_day_message(start_date_iso: str) -> str:
@@ -289,20 +404,21 @@ def build_first_day_message(start_date_iso: str) -> str:
 
 @router.message(F.text)
 async def on_text(msg: Message) -> None:
-    uid = str(msg.from_user.id)
+    uid = msg.from_user.id
     text = (msg.text or "").strip()
+    step = _pending_step(uid)
 
     # Onboarding: waiting for timezone
-    if uid in pending_onboarding and pending_onboarding[uid].get("step") == "timezone":
+    if step == "timezone":
         tz = parse_timezone(text)
         if tz is None:
             await msg.answer("Неверный формат. Введите число часов от UTC, например +5 или -7:")
             return
         today_iso = user_local_date_str(tz)
         date_display = format_date_dd_mm_yyyy(today_iso)
-        pending_onboarding[uid]["step"] = "confirm_date"
-        pending_onboarding[uid]["timezone"] = tz
-        pending_onboarding[uid]["today_iso"] = today_iso
+        pending_onboarding[uid].update(
+            step="confirm_date", ts=time.monotonic(), timezone=tz, today_iso=today_iso
+        )
         keyb = InlineKeyboardMarkup(inline_keyboard=[
             [
                 InlineKeyboardButton(text="Подтвердить", callback_data="start_confirm_yes"),
@@ -317,14 +433,14 @@ async def on_text(msg: Message) -> None:
         return
 
     # Onboarding: optional date (user chose "Другая дата")
-    if uid in pending_onboarding and pending_onboarding[uid].get("step") == "optional_date":
+    if step == "optional_date":
         start_date = parse_date(text)
         if not start_date:
             await msg.answer("Неверный формат. Введите дату в формате ГГГГ-ММ-ДД (например 2025-03-01):")
             return
         tz = pending_onboarding[uid]["timezone"]
-        _save_new_user(uid, start_date, tz)
-        del pending_onboarding[uid]
+        await _save_new_user(str(uid), start_date, tz)
+        pending_onboarding.pop(uid, None)
         keyb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="Готово", callback_data="first_ready")],
         ])
@@ -335,17 +451,16 @@ async def on_text(msg: Message) -> None:
         return
 
     # Free-text "Принял": выпил, выпила, принял, таблетка, etc.
-    data = load_data()
-    if uid in data["users"] and uid not in pending_onboarding:
-        u = data["users"][uid]
-        _migrate_user_reminders(u)
-        if not u.get("courseCompleted") and any(phrase in text.lower() for phrase in TAKEN_PHRASES):
-            now = datetime.utcnow()
-            completion = _apply_taken(u, now)
-            save_data(data)
-            await msg.answer("✓ Учтено.")
-            if completion:
-                await msg.answer(completion)
+    users = _STATE["users"]
+    key = str(uid)
+    if key in users and step is None:
+        u = users[key]
+        if not u.courseCompleted and _TAKEN_RE.search(text) is not None:
+            completion = _apply_taken(u, time.time())
+            schedule_reminders(key, u)
+            mark_dirty()
+            await flush_data()
+            await msg.answer(_with_completion("✓ Учтено.", completion))
             return
 
 
@@ -359,6 +474,7 @@ CB_MISSED_NO = "missed_no"
 TAKEN_PHRASES = frozenset(s.lower() for s in (
     "выпил", "выпила", "выпил таблетку", "принял", "таблетка",
 ))
+_TAKEN_RE = re.compile("|".join(map(re.escape, sorted(TAKEN_PHRASES))), re.IGNORECASE)
 
 
 def dose_keyboard() -> InlineKeyboardMarkup:
@@ -370,74 +486,75 @@ def dose_keyboard() -> InlineKeyboardMarkup:
     ])
 
 
-def _apply_taken(u: dict, now: datetime) -> str | None:
+def _apply_taken(u: User, now_ts: float) -> str | None:
     """
-    Apply "Принял" logic to user dict (mutates u).
-    Clears nextReminderTimestamp and postponedReminderTimestamp.
+    Apply "Принял" logic to the user (mutates u).
+    Clears nextReminderEpoch and postponedReminderEpoch.
     Returns completion message if course just finished, else None.
     """
-    u["takenToday"] = u.get("takenToday", 0) + 1
-    u["lastDoseTimestamp"] = now.isoformat() + "Z"
-    u["nextReminderTimestamp"] = None
-    u["postponedReminderTimestamp"] = None
-    day = u.get("currentDay", 1)
+    u.takenToday += 1
+    u.lastDoseTimestamp = datetime.utcfromtimestamp(now_ts).isoformat() + "Z"
+    u.nextReminderEpoch = None
+    u.postponedReminderEpoch = None
+    day = u.currentDay
     required = get_required_doses(day)
-    if u["takenToday"] >= required:
-        u["currentDay"] = day + 1
-        u["takenToday"] = 0
-        u["lastMorningMessageDate"] = None
-    next_day = u.get("currentDay", 1)
+    if u.takenToday >= required:
+        u.currentDay = day + 1
+        u.takenToday = 0
+        u.lastMorningMessageDate = None
+    next_day = u.currentDay
     if next_day > 25:
-        u["courseCompleted"] = True
-        return (
-            "Поздравляем! Вы завершили курс приёма Табекс по схеме 25 дней. "
-            "Бот является напоминалкой и не заменяет консультацию врача."
-        )
+        u.courseCompleted = True
+        return COMPLETION_MESSAGE
     if next_day <= 25:
         interval_h = get_interval_hours(next_day)
-        u["nextReminderTimestamp"] = (now + timedelta(hours=interval_h)).isoformat() + "Z"
+        u.nextReminderEpoch = now_ts + interval_h * 3600
     return None
 
 
+def _with_completion(text: str, completion: str | None) -> str:
+    """Append the course completion message so it goes out in the same API call."""
+    return f"{text}\n\n{completion}" if completion else text
+
+
 @router.callback_query(F.data == CB_TAKEN)
 async def cb_taken(cq: CallbackQuery) -> None:
     uid = str(cq.from_user.id)
-    data = load_data()
-    if uid not in data["users"]:
+    users = _STATE["users"]
+    if uid not in users:
         await cq.answer("Ошибка: пользователь не найден.", show_alert=True)
         return
-    u = data["users"][uid]
-    _migrate_user_reminders(u)
-    if u.get("courseCompleted"):
+    u = users[uid]
+    if u.courseCompleted:
         await cq.answer("Курс уже завершён.")
         return
     await cq.answer()
-    now = datetime.utcnow()
-    completion = _apply_taken(u, now)
-    save_data(data)
+    completion = _apply_taken(u, time.time())
+    schedule_reminders(uid, u)
+    mark_dirty()
+    await flush_data()
     try:
-        await cq.message.edit_text((cq.message.text or "Приём") + "\n\n✓ Учтено.")
+        await cq.message.edit_text(_with_completion((cq.message.text or "Приём") + "\n\n✓ Учтено.", completion))
     except Exception:
-        await cq.message.answer("✓ Учтено.")
-    if completion:
-        await cq.message.answer(completion)
+        await cq.message.answer(_with_completion("✓ Учтено.", completion))
 
 
 @router.callback_query(F.data == CB_POSTPONE)
 async def cb_postpone(cq: CallbackQuery) -> None:
     uid = str(cq.from_user.id)
-    data = load_data()
-    if uid not in data["users"]:
+    users = _STATE["users"]
+    if uid not in users:
         await cq.answer("Ошибка: пользователь не найден.", show_alert=True)
         return
-    u = data["users"][uid]
-    if u.get("courseCompleted"):
+    u = users[uid]
+    if u.courseCompleted:
         await cq.answer("Курс уже завершён.")
         return
     await cq.answer("Напоминание через 15 минут")
-    trigger_at = (datetime.utcnow() + timedelta(minutes=15)).isoformat() + "Z"
-    u["postponedReminderTimestamp"] = trigger_at
-    save_data(data)
+    u.postponedReminderEpoch = time.time() + 15 * 60
+    schedule_reminders(uid, u)
+    mark_dirty()
+    await flush_data()
     try:
         await cq.message.edit_text((cq.message.text or "Приём") + "\n\nНапомню через 15 минут.")
     except Exception:
@@ -447,28 +564,36 @@ async def cb_postpone(cq: CallbackQuery) -> None:
 @router.callback_query(F.data.startswith(CB_MISSED_YES))
 async def cb_missed_yes(cq: CallbackQuery) -> None:
     uid = str(cq.from_user.id)
-    data = load_data()
-    if uid not in data["users"]:
+    users = _STATE["users"]
+    if uid not in users:
         await cq.answer("Ошибка: пользователь не найден.", show_alert=True)
         return
+    u = users[uid]
+    if u.courseCompleted:
+        await cq.answer("Курс уже завершён.")
+        return
     await cq.answer()
-    u = data["users"][uid]
-    _migrate_user_reminders(u)
-    u["nextReminderTimestamp"] = None
-    u["postponedReminderTimestamp"] = None
-    day = u.get("currentDay", 1)
+    u.nextReminderEpoch = None
+    u.postponedReminderEpoch = None
+    day = u.currentDay
     required = get_required_doses(day)
-    missed = required - u.get("takenToday", 0)
-    u["takenToday"] = u.get("takenToday", 0) + missed
-    if u["takenToday"] >= required:
-        u["currentDay"] = day + 1
-        u["takenToday"] = 0
-        u["lastMorningMessageDate"] = None
-    save_data(data)
+    missed = required - u.takenToday
+    u.takenToday += missed
+    if u.takenToday >= required:
+        u.currentDay = day + 1
+        u.takenToday = 0
+        u.lastMorningMessageDate = None
+    completion = None
+    if u.currentDay > 25:
+        u.courseCompleted = True
+        completion = COMPLETION_MESSAGE
+    mark_dirty()
+    await flush_data()
+    done = "Приёмы отмечены выполненными."
     try:
-        await cq.message.edit_text((cq.message.text or "") + "\n\nПриёмы отмечены выполненными.")
+        await cq.message.edit_text(_with_completion((cq.message.text or "") + "\n\n" + done, completion))
     except Exception:
-        await cq.message.answer("Приёмы отмечены выполненными.")
+        await cq.message.answer(_with_completion(done, completion))
 
 
 @router.callback_query(F.data.startswith(CB_MISSED_NO))
@@ -483,19 +608,19 @@ async def cb_missed_no(cq: CallbackQuery) -> None:
 # --- Onboarding callbacks: confirm start date, first dose "Готово" ---
 @router.callback_query(F.data == "start_confirm_yes")
 async def cb_start_confirm_yes(cq: CallbackQuery) -> None:
-    uid = str(cq.from_user.id)
-    if uid not in pending_onboarding or pending_onboarding[uid].get("step") != "confirm_date":
+    uid = cq.from_user.id
+    if _pending_step(uid) != "confirm_date":
         await cq.answer("Сессия устарела.", show_alert=True)
         try:
             await cq.message.edit_text("Сессия устарела. Отправьте /start заново.")
         except Exception:
             await cq.message.answer("Сессия устарела. Отправьте /start заново.")
         return
+    p = pending_onboarding.pop(uid)
+    today_iso = p["today_iso"]
+    tz = p["timezone"]
     await cq.answer()
-    today_iso = pending_onboarding[uid]["today_iso"]
-    tz = pending_onboarding[uid]["timezone"]
-    _save_new_user(uid, today_iso, tz)
-    del pending_onboarding[uid]
+    await _save_new_user(str(uid), today_iso, tz)
     keyb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Готово", callback_data="first_ready")],
     ])
@@ -508,16 +633,16 @@ async def cb_start_confirm_yes(cq: CallbackQuery) -> None:
 
 @router.callback_query(F.data == "start_confirm_no")
 async def cb_start_confirm_no(cq: CallbackQuery) -> None:
-    uid = str(cq.from_user.id)
-    if uid not in pending_onboarding or pending_onboarding[uid].get("step") != "confirm_date":
+    uid = cq.from_user.id
+    if _pending_step(uid) != "confirm_date":
         await cq.answer("Сессия устарела.", show_alert=True)
         try:
             await cq.message.edit_text("Сессия устарела. Отправьте /start заново.")
         except Exception:
             await cq.message.answer("Сессия устарела. Отправьте /start заново.")
         return
+    pending_onboarding[uid].update(step="optional_date", ts=time.monotonic())
     await cq.answer()
-    pending_onboarding[uid]["step"] = "optional_date"
     await cq.message.edit_reply_markup(reply_markup=None)
     await cq.message.answer(
         "Введите дату начала приёма в формате ГГГГ-ММ-ДД (например 2025-03-01):"
@@ -527,20 +652,21 @@ async def cb_start_confirm_no(cq: CallbackQuery) -> None:
 @router.callback_query(F.data == "first_ready")
 async def cb_first_ready(cq: CallbackQuery) -> None:
     uid = str(cq.from_user.id)
-    data = load_data()
-    if uid not in data["users"]:
+    users = _STATE["users"]
+    if uid not in users:
         await cq.answer("Ошибка: пользователь не найден.", show_alert=True)
         return
-    u = data["users"][uid]
-    _migrate_user_reminders(u)
-    if u.get("courseCompleted"):
+    u = users[uid]
+    if u.courseCompleted:
         await cq.answer("Курс уже завершён.")
         return
-    day = u.get("currentDay", 1)
+    day = u.currentDay
     interval_h = get_interval_hours(day)
-    now = datetime.utcnow()
-    completion = _apply_taken(u, now)
-    save_data(data)
+    now_ts = time.time()
+    completion = _apply_taken(u, now_ts)
+    schedule_reminders(uid, u)
+    mark_dirty()
+    await flush_data()
     # Убираем кнопку у предыдущего сообщения
     try:
         await cq.message.edit_reply_markup(reply_markup=None)
@@ -548,145 +674,210 @@ async def cb_first_ready(cq: CallbackQuery) -> None:
         pass
     await cq.answer()
     # Отправляем отдельное сообщение с подтверждением (видно всегда)
-    next_at_utc = now + timedelta(hours=interval_h)
-    try:
-        tz = int(u.get("timezone", 0))
-        next_at_user = next_at_utc + timedelta(hours=tz)
-        next_time_str = next_at_user.strftime("%H:%M")
-    except (ValueError, TypeError):
-        next_time_str = next_at_utc.strftime("%H:%M")
+    next_at_user = datetime.utcfromtimestamp(now_ts + (interval_h + u.timezone) * 3600)
+    next_time_str = next_at_user.strftime("%H:%M")
     reply = (
         f"✓ Записали. Первый приём учтён.\n\n"
         f"Следующий приём — через {interval_h} ч. (напоминание придёт около {next_time_str} по вашему времени)."
     )
-    await cq.message.answer(reply)
-    if completion:
-        await cq.message.answer(completion)
+    await cq.message.answer(_with_completion(reply, completion))
 
 
 dp.include_router(router)
 
 
 # --- Scheduler ---------------------------------------------------------------
+REMINDER_KEYS = ("nextReminderEpoch", "postponedReminderEpoch")
+_CLOCK = "clock"  # heap entry kind for the 60-second wall-clock tick()
+# Local minute-of-day windows (inclusive) for tick(): 07:59–08:01 and 20:59–21:02
+MORNING_WINDOW = (7 * 60 + 59, 8 * 60 + 1)
+EVENING_CHECK_WINDOW = (20 * 60 + 59, 21 * 60 + 2)
+
+# Min-heap of (due_epoch, uid, kind). kind is a key from REMINDER_KEYS or _CLOCK.
+# Entries are never removed in place: when popped, a reminder entry is stale (and
+# skipped) unless the user's field still holds the same due time.
+_due_heap: list[tuple[float, str, str]] = []
+
+# Active (not completed) user ids bucketed by timezone offset, so tick() only visits
+# the offsets whose local time is inside a wall-clock window. Completed users are
+# dropped from their bucket the next time tick() sees them.
+_by_tz: dict[int, set[str]] = {}
+
+
+# Scheduler sends per second, below Telegram's ~30 messages/second global limit. Each send
+# holds one of these slots for at least a second, so at most this many start per second.
+SEND_RATE_LIMIT = 25
+_send_slots = asyncio.Semaphore(SEND_RATE_LIMIT)
+
+# (log label, uid, send coroutine) queued during a scheduler pass
+PendingSend = tuple[str, str, Coroutine[Any, Any, Any]]
+
+
+async def _limited_send(uid: str, text: str, reply_markup: InlineKeyboardMarkup | None = None) -> None:
+    """Send within SEND_RATE_LIMIT; on a 429, wait retry_after and try once more."""
+    async with _send_slots:
+        started = time.monotonic()
+        try:
+            try:
+                await bot.send_message(uid, text, reply_markup=reply_markup)
+            except TelegramRetryAfter as e:
+                logger.warning("Rate limited sending to %s, retrying in %s s", uid, e.retry_after)
+                await asyncio.sleep(e.retry_after)
+                await bot.send_message(uid, text, reply_markup=reply_markup)
+        finally:
+            await asyncio.sleep(max(0.0, 1.0 - (time.monotonic() - started)))
+
+
+async def send_batch(sends: list[PendingSend]) -> None:
+    """Run queued sends concurrently; log each failure instead of aborting the batch."""
+    if not sends:
+        return
+    results = await asyncio.gather(*(coro for _, _, coro in sends), return_exceptions=True)
+    for (label, uid, _), res in zip(sends, results):
+        if isinstance(res, Exception):
+            logger.warning("%s to %s failed: %s", label, uid, res)
+
+
+def schedule_reminders(uid: str, u: User) -> None:
+    """Push the user's pending reminder due times onto the scheduler heap."""
+    for key in REMINDER_KEYS:
+        due_at = getattr(u, key)
+        if due_at is not None:
+            heapq.heappush(_due_heap, (due_at, uid, key))
+
+
+async def _rebuild_schedule() -> None:
+    """Build the due-time heap and timezone buckets from _STATE."""
+    _due_heap.clear()
+    _by_tz.clear()
+    for uid, u in _STATE["users"].items():
+        if not u.courseCompleted:
+            schedule_reminders(uid, u)
+            _by_tz.setdefault(u.timezone, set()).add(uid)
+    heapq.heappush(_due_heap, (time.time(), "", _CLOCK))
+    await flush_data()
+
+
 async def run_scheduler() -> None:
-    """Every 60 seconds: morning message, dose reminders, 21:00 check, pending reminders."""
+    """Sleep until the earliest heap entry is due: dose reminders, plus tick() every 60 seconds."""
+    await _rebuild_schedule()
     while True:
+        await asyncio.sleep(max(0.0, _due_heap[0][0] - time.time()))
         try:
-            await tick()
+            await process_due()
         except Exception as e:
             logger.exception("Scheduler tick error: %s", e)
-        await asyncio.sleep(60)
-
 
-async def tick() -> None:
-    data = load_data()
-    users = data["users"]
-    now_utc = datetime.utcnow()
 
-    for uid, u in list(users.items()):
-        if u.get("courseCompleted"):
-            continue
-        try:
-            tz = int(u.get("timezone", 0))
-        except (ValueError, TypeError):
+async def process_due() -> None:
+    """
+    Pop every heap entry that is due: dose reminders, plus tick() for the clock entry.
+    All state changes of the pass are saved with a single write before any message is sent.
+    """
+    users = _STATE["users"]
+    now_ts = time.time()
+    run_clock = False
+    sends: list[PendingSend] = []
+
+    while _due_heap and _due_heap[0][0] <= now_ts:
+        due_at, uid, key = heapq.heappop(_due_heap)
+        if key == _CLOCK:
+            heapq.heappush(_due_heap, (now_ts + 60, "", _CLOCK))
+            run_clock = True
             continue
-        today_user = user_local_date_str(tz)
-        time_user = user_local_time_str(tz)
-        day = u.get("currentDay", 1)
-        if day > 25:
-            # Course completed
-            u["courseCompleted"] = True
-            save_data(data)
-            try:
-                await bot.send_message(
-                    uid,
-                    "Поздравляем! Вы завершили курс приёма Табекс по схеме 25 дней. "
-                    "Бот является напоминалкой и не заменяет консультацию врача."
-                )
-            except Exception as e:
-                logger.warning("Failed to send completion message to %s: %s", uid, e)
+        u = users.get(uid)
+        if u is None or getattr(u, key) != due_at or u.courseCompleted:
             continue
+        setattr(u, key, None)
+        mark_dirty()
+        sends.append((f"{key} reminder", uid, _limited_send(
+            uid,
+            f"Напоминание: приём Табекс ({u.currentDay}-й день).",
+            reply_markup=dose_keyboard(),
+        )))
 
-        required = get_required_doses(day)
-        interval_desc = get_interval_description(day)
+    if run_clock:
+        sends.extend(tick())
+    await flush_data()
+    await send_batch(sends)
 
-        # 1) Morning summary at 08:00, once per day — "примите первую таблетку, нажмите Готово"
-        if time_user >= "07:59" and time_user <= "08:01":
-            if u.get("lastMorningMessageDate") != today_user:
-                u["lastMorningMessageDate"] = today_user
-                save_data(data)
-                keyb = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="Готово", callback_data="first_ready")],
-                ])
-                try:
-                    await bot.send_message(
+
+def tick() -> list[PendingSend]:
+    """
+    Wall-clock checks for every user: course completion, 08:00 morning message, 21:00 missed check.
+    Only updates state (marking it dirty) and returns the messages to send; the caller saves and sends.
+    """
+    users = _STATE["users"]
+    _gc_pending()
+    now_ts = time.time()
+    utc_min = int(now_ts // 60) % 1440
+
+    sends: list[PendingSend] = []
+    # tick() never awaits, so no handler can touch users or _by_tz while it runs; the
+    # buckets are iterated in place and finished users are removed after each one.
+    for tz, bucket in _by_tz.items():
+        local_min = (utc_min + tz * 60) % 1440
+        in_morning = MORNING_WINDOW[0] <= local_min <= MORNING_WINDOW[1]
+        in_evening = EVENING_CHECK_WINDOW[0] <= local_min <= EVENING_CHECK_WINDOW[1]
+        if not (in_morning or in_evening):
+            continue
+        today_user = datetime.utcfromtimestamp(now_ts + tz * 3600).strftime("%Y-%m-%d")
+
+        finished: list[str] = []
+        for uid in bucket:
+            u = users.get(uid)
+            if u is None or u.courseCompleted:
+                finished.append(uid)
+                continue
+            day = u.currentDay
+            if day > 25:
+                # Course completed
+                u.courseCompleted = True
+                finished.append(uid)
+                mark_dirty()
+                sends.append(("Completion message", uid, _limited_send(uid, COMPLETION_MESSAGE)))
+                continue
+
+            required = get_required_doses(day)
+            interval_desc = get_interval_description(day)
+
+            # 1) Morning summary at 08:00, once per day — "примите первую таблетку, нажмите Готово"
+            if in_morning:
+                if u.lastMorningMessageDate != today_user:
+                    u.lastMorningMessageDate = today_user
+                    mark_dirty()
+                    keyb = InlineKeyboardMarkup(inline_keyboard=[
+                        [InlineKeyboardButton(text="Готово", callback_data="first_ready")],
+                    ])
+                    sends.append(("Morning message", uid, _limited_send(
                         uid,
                         f"Доброе утро! Сегодня {day}-й день приёма Табекс.\n"
                         f"Сегодня нужно принять {required} таблеток ({interval_desc}).\n"
                         "Примите первую таблетку и нажмите «Готово» — следующее напоминание придёт через нужный интервал.",
                         reply_markup=keyb,
-                    )
-                except Exception as e:
-                    logger.warning("Morning message to %s failed: %s", uid, e)
-
-        # 2) 21:00 check: missed doses
-        if time_user >= "20:59" and time_user <= "21:02":
-            missed = required - u.get("takenToday", 0)
-            check_key = "last21Check"
-            if missed > 0 and u.get(check_key) != today_user:
-                u[check_key] = today_user
-                save_data(data)
-                keyb = InlineKeyboardMarkup(inline_keyboard=[
-                    [
-                        InlineKeyboardButton(text="Да", callback_data=CB_MISSED_YES),
-                        InlineKeyboardButton(text="Нет", callback_data=CB_MISSED_NO),
-                    ]
-                ])
-                try:
-                    await bot.send_message(
+                    )))
+
+            # 2) 21:00 check: missed doses
+            if in_evening:
+                missed = required - u.takenToday
+                if missed > 0 and u.last21Check != today_user:
+                    u.last21Check = today_user
+                    mark_dirty()
+                    keyb = InlineKeyboardMarkup(inline_keyboard=[
+                        [
+                            InlineKeyboardButton(text="Да", callback_data=CB_MISSED_YES),
+                            InlineKeyboardButton(text="Нет", callback_data=CB_MISSED_NO),
+                        ]
+                    ])
+                    sends.append(("21:00 check message", uid, _limited_send(
                         uid,
                         f"Вы пропустили {missed} приём(ов). Хотите выполнить их сейчас?",
                         reply_markup=keyb,
-                    )
-                except Exception as e:
-                    logger.warning("21:00 check message to %s failed: %s", uid, e)
-
-        # 3) nextReminderTimestamp or postponedReminderTimestamp due → send reminder, then clear
-        need_save = _migrate_user_reminders(u)
-        next_ts = u.get("nextReminderTimestamp")
-        post_ts = u.get("postponedReminderTimestamp")
-        if next_ts:
-            try:
-                next_dt = datetime.fromisoformat(next_ts.replace("Z", "+00:00"))
-                if now_utc >= next_dt:
-                    await bot.send_message(
-                        uid,
-                        f"Напоминание: приём Табекс ({day}-й день).",
-                        reply_markup=dose_keyboard(),
-                    )
-                    u["nextReminderTimestamp"] = None
-                    need_save = True
-            except Exception as e:
-                logger.warning("nextReminderTimestamp parse/send for %s: %s", uid, e)
-                u["nextReminderTimestamp"] = None
-                need_save = True
-        if post_ts:
-            try:
-                post_dt = datetime.fromisoformat(post_ts.replace("Z", "+00:00"))
-                if now_utc >= post_dt:
-                    await bot.send_message(
-                        uid,
-                        f"Напоминание: приём Табекс ({day}-й день).",
-                        reply_markup=dose_keyboard(),
-                    )
-                    u["postponedReminderTimestamp"] = None
-                    need_save = True
-            except Exception as e:
-                logger.warning("postponedReminderTimestamp parse/send for %s: %s", uid, e)
-                u["postponedReminderTimestamp"] = None
-                need_save = True
-        if need_save:
-            save_data(data)
+                    )))
+
+        bucket.difference_update(finished)
+
+    return sends
 
 
 # --- Main --------------------------------------------------------------------
@@ -696,8 +887,14 @@ async def main() -> None:
         raise SystemExit(1)
     logger.info("Starting TabexReminder (long polling + scheduler)")
     dp["scheduler_task"] = asyncio.create_task(run_scheduler())
-    await dp.start_polling(bot)
+    await dp.start_polling(bot, polling_timeout=POLLING_TIMEOUT)
 
 
 if __name__ == "__main__":
+    try:
+        import uvloop  # optional: faster event loop, not available on Windows
+    except ImportError:
+        pass
+    else:
+        uvloop.install()
     asyncio.run(main())